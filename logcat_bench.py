@@ -0,0 +1,687 @@
+#!/data/data/com.termux/files/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Logcat监控器管道基准 - 不需要设备，普通 Linux 上就能跑
+
+用假的 logcat/pidof/ps 和假的 /proc 目录代替设备，按设定的速率、行长分布和重启模式
+产生 threadtime 日志，让 logcat.py 的完整管道(读取 → 分发 → 过滤 → 写入 → 轮转 → 压缩)
+在子进程里运行，结束后报告:
+- 持续吞吐(行/秒)、每百万行CPU时间、峰值RSS
+- 轮转耗时和写入队列写满时的阻塞时间
+- 应用重启(PID交接)和 logcat 重启时丢失/重复的行数(逐行核对)
+- 打开 --ship 时，本机假收集端收到的内容和磁盘上的分段逐字节核对
+- 打开 --preallocate 时，结束前对正在写的(末尾预留0的)分段做 query/stats，核对不会读到预留的0
+
+使用方法:
+    python logcat_bench.py                          # 默认: 2个包, 20000行/秒, 20秒, 应用每5秒重启
+    python logcat_bench.py --rate 0 --duration 10   # 不限速，测最大吞吐(上限也受假 logcat 生成速度限制)
+    python logcat_bench.py --logcat-restart 4       # logcat 每4秒退出一次，测 -T 续读交接
+    python logcat_bench.py --buffers ""             # 只读默认缓冲区的一个流(不归并)，和按缓冲区归并对比
+    python logcat_bench.py --preallocate --file-size-mb 64   # 预分配分段，并检查对正在写的分段的 query/stats
+    python logcat_bench.py --ship --ship-fail-rate 0.2   # 上传到本机假收集端，20% 的请求返回503测重试
+    python logcat_bench.py --profile cprofile --keep     # 运行期间用 profile 命令的方式剖析监控进程，结果在 logs/profiles
+    python logcat_bench.py --line-length 60:5,200:3,1500:1 --json
+    python logcat_bench.py --min-rate 15000 --max-lost 0   # 不达标时退出码为1，可以用来卡提交
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logcat
+
+# 默认参数
+BENCH_PACKAGES = 2  # 监控的包数
+BENCH_RATE = 20000  # 假 logcat 每秒输出的总行数，0 表示不限速
+BENCH_DURATION = 20  # 秒
+BENCH_APP_SHARE = 0.3  # 属于被监控应用的行的比例，其余是系统进程的噪声
+BENCH_LINE_LENGTH = "40:3,90:5,160:3,400:1,1500:0.2"  # 消息长度:权重
+BENCH_APP_RESTART = 5  # 每个应用每隔几秒换一次PID，0 表示不重启
+BENCH_LOGCAT_RESTART = 0  # logcat 每隔几秒退出一次(监控会用 -T 续读)，0 表示不退出
+BENCH_FILE_SIZE_MB = 8  # 分段大小，比默认小很多，基准期间会发生多次轮转
+BENCH_DRAIN_SECONDS = 2  # 停止产生日志后，留给监控把管道里剩下的日志写完的时间
+
+NOISE_PIDS = 40  # 噪声进程数
+TAGS = [b"ActivityManager", b"OkHttp", b"Choreographer", b"chromium", b"WindowManager", b"InputDispatcher",
+        b"PackageManager", b"BluetoothAdapter", b"wpa_supplicant", b"SurfaceFlinger"]
+APP_TAGS = [b"BenchApp%02d" % i for i in range(16)]
+SEQ_PATTERN = re.compile(rb"bench seq=(\d+-\d+)")
+FIRST_FAKE_PID = 20000
+CRASH_INTERVAL = 0.5  # 假 crash 缓冲区每隔0.5秒给每个应用输出一行
+
+
+def parse_line_lengths(spec):
+    """'60:5,200:3' -> ([60, 200], [5.0, 3.0])"""
+    lengths, weights = [], []
+    for item in spec.split(","):
+        length, _, weight = item.partition(":")
+        lengths.append(int(length))
+        weights.append(float(weight or 1))
+    return lengths, weights
+
+
+# ===== 假命令(由生成的 logcat/pidof/ps 包装脚本调用) =====
+
+def read_fake_pids(proc_dir):
+    """假 /proc 目录里的 {PID: 进程名}"""
+    pids = {}
+    for entry in os.listdir(proc_dir):
+        if entry.isdigit():
+            try:
+                with open(os.path.join(proc_dir, entry, "cmdline"), "rb") as f:
+                    pids[entry] = f.read().split(b"\0", 1)[0].decode("utf-8")
+            except OSError:
+                pass
+    return pids
+
+
+def threadtime_now():
+    now = time.time()
+    return (time.strftime("%m-%d %H:%M:%S", time.localtime(now)) + ".%03d" % int(now % 1 * 1000)).encode("ascii")
+
+
+def fake_events(config):
+    """假 events 缓冲区：假 /proc 里的应用进程出现/消失时输出 am_proc_start/am_proc_died"""
+    out = sys.stdout.buffer
+    known = {}
+    while True:
+        current = {pid: name for pid, name in read_fake_pids(config["proc_dir"]).items() if name.startswith("com.")}
+        lines = []
+        for pid, name in current.items():
+            if pid not in known:
+                lines.append(b"%s  1000  1000 I am_proc_start: [0,%s,10123,%s,activity,{%s/.Main}]\n"
+                             % (threadtime_now(), pid.encode(), name.encode(), name.encode()))
+        for pid, name in known.items():
+            if pid not in current:
+                lines.append(b"%s  1000  1000 I am_proc_died: [0,%s,%s,900,17]\n"
+                             % (threadtime_now(), pid.encode(), name.encode()))
+        known = current
+        if lines:
+            out.write(b"".join(lines))
+            out.flush()
+        time.sleep(0.02)
+
+
+def fake_crash(config):
+    """假 crash 缓冲区：每隔一段时间给每个应用进程输出一行 AndroidRuntime 错误，和 main 缓冲区交错"""
+    out = sys.stdout.buffer
+    while True:
+        time.sleep(CRASH_INTERVAL)
+        lines = [b"%s %5s %5s E AndroidRuntime: bench crash marker\n" % (threadtime_now(), pid.encode(), pid.encode())
+                 for pid, name in sorted(read_fake_pids(config["proc_dir"]).items()) if name.startswith("com.")]
+        if lines:
+            out.write(b"".join(lines))
+            out.flush()
+
+
+def fake_logcat(args):
+    """假 logcat：按配置的速率输出 threadtime 日志，-T 时先从历史里回放"""
+    workdir = os.environ["LOGCAT_BENCH_DIR"]
+    with open(os.path.join(workdir, "config.json")) as f:
+        config = json.load(f)
+    buffer = args[args.index("-b") + 1] if "-b" in args else "main"
+    if buffer == "events":
+        fake_events(config)
+    elif buffer == "crash":
+        fake_crash(config)
+    elif buffer != "main":
+        while True:  # system 等其他缓冲区没有日志
+            time.sleep(3600)
+
+    out = sys.stdout.buffer
+    history_path = os.path.join(workdir, "history.log")
+    if "-T" in args and os.path.exists(history_path):
+        since = args[args.index("-T") + 1].encode("ascii")
+        with open(history_path, "rb") as f:
+            for line in f:
+                if line[:18] >= since:
+                    out.write(line)
+        out.flush()
+    history = open(history_path, "ab", buffering=0) if config["logcat_restart"] else None
+    ledger = open(os.path.join(workdir, "ledger.%d" % os.getpid()), "wb", buffering=0)
+
+    rng = random.Random(os.getpid())
+    lengths, weights = parse_line_lengths(config["line_length"])
+    bodies = [b"x" * rng.choices(lengths, weights)[0] for _ in range(997)]
+    noise = []
+    for i in range(4093):
+        pid = 1000 + (i % NOISE_PIDS) * 37
+        noise.append(b" %5d %5d %c %s: %s\n" % (pid, pid + i % 7, b"VDIWE"[rng.randrange(5)],
+                                                 TAGS[i % len(TAGS)], bodies[i % len(bodies)]))
+    app_every = max(1, round(1 / config["app_share"])) if config["app_share"] else 0
+    rate = config["rate"]
+    stop_path = os.path.join(workdir, "stop")
+
+    started = time.monotonic()
+    emitted = seq = 0
+    app_pids = []
+    checked = 0
+    stopped = False
+    token = b"%d-" % os.getpid()
+    while True:
+        now = time.monotonic()
+        if now - checked > 0.05:
+            checked = now
+            app_pids = [pid.encode() for pid, name in sorted(read_fake_pids(config["proc_dir"]).items())
+                        if name.startswith("com.")]
+            stopped = os.path.exists(stop_path)
+            if config["logcat_restart"] and now - started > config["logcat_restart"]:
+                return  # 模拟 logcat 意外退出
+        if stopped:
+            time.sleep(0.05)
+            continue
+
+        due = min(int(rate * (now - started)) - emitted, 20000) if rate else 5000
+        if due <= 0:
+            time.sleep(0.002)
+            continue
+        ts = threadtime_now()
+        lines = []
+        app_lines = []
+        for i in range(emitted, emitted + due):
+            if app_every and app_pids and i % app_every == 0:
+                pid = app_pids[seq % len(app_pids)]
+                seq += 1
+                app_lines.append(b"%s %d\n" % (pid, seq))
+                lines.append(b"%s %5s %5s I %s: bench seq=%s%d %s\n"
+                             % (ts, pid, pid, APP_TAGS[seq % len(APP_TAGS)], token, seq, bodies[seq % len(bodies)]))
+            else:
+                lines.append(ts + noise[i % len(noise)])
+        emitted += due
+        data = b"".join(lines)
+        try:
+            out.write(data)
+            out.flush()
+        except BrokenPipeError:
+            return
+        if history is not None:
+            history.write(data)
+        ledger.write(b"".join(app_lines))
+
+
+def fake_pidof(args):
+    """假 pidof：在假 /proc 里按进程名查找"""
+    proc_dir = json.load(open(os.path.join(os.environ["LOGCAT_BENCH_DIR"], "config.json")))["proc_dir"]
+    pids = [pid for pid, name in read_fake_pids(proc_dir).items() if name in args]
+    if not pids:
+        sys.exit(1)
+    print(" ".join(pids))
+
+
+def fake_ps(args):
+    """假 ps -A：输出 USER PID ... NAME"""
+    proc_dir = json.load(open(os.path.join(os.environ["LOGCAT_BENCH_DIR"], "config.json")))["proc_dir"]
+    print("USER           PID  PPID     VSZ    RSS WCHAN            ADDR S NAME")
+    for pid, name in sorted(read_fake_pids(proc_dir).items()):
+        print(f"u0_a123      {pid:>5}   100 1000000  50000 0                   0 S {name}")
+
+
+# ===== 基准主体 =====
+
+class FakeDevice:
+    """假设备：假 /proc 目录 + PATH 里的假命令，定时给应用换PID"""
+
+    def __init__(self, workdir, packages, app_restart):
+        self.workdir = workdir
+        self.proc_dir = os.path.join(workdir, "proc")
+        self.bin_dir = os.path.join(workdir, "bin")
+        self.packages = packages
+        self.app_restart = app_restart
+        self.pid_owner = {}  # 每个出现过的PID -> 包名
+        self._current = {}  # 包名 -> 当前PID
+        self._next_pid = FIRST_FAKE_PID
+        self._last_restart = 0
+
+        os.makedirs(self.bin_dir)
+        for command in ("logcat", "pidof", "ps"):
+            path = os.path.join(self.bin_dir, command)
+            with open(path, "w") as f:
+                f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" fake-{command} "$@"\n')
+            os.chmod(path, 0o755)
+
+        self._create("1", "init")  # 有 1 号进程，PidTracker 才认为 /proc 可用
+        for package in packages:
+            self.start_app(package)
+        self._last_restart = time.monotonic()
+
+    def _create(self, pid, name):
+        os.makedirs(os.path.join(self.proc_dir, pid))
+        with open(os.path.join(self.proc_dir, pid, "cmdline"), "wb") as f:
+            f.write(name.encode("utf-8") + b"\0")
+
+    def start_app(self, package):
+        old = self._current.get(package)
+        if old:
+            shutil.rmtree(os.path.join(self.proc_dir, old), ignore_errors=True)
+        pid = str(self._next_pid)
+        self._next_pid += 1
+        self._create(pid, package)
+        self._current[package] = pid
+        self.pid_owner[pid] = package
+
+    def tick(self):
+        """到时间就按顺序重启应用"""
+        if self.app_restart and time.monotonic() - self._last_restart >= self.app_restart:
+            self._last_restart = time.monotonic()
+            for package in self.packages:
+                self.start_app(package)
+
+
+def read_process_usage(pid):
+    """(用户态+内核态CPU秒, 峰值RSS字节)，只算监控进程本身，不含假 logcat"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    peak_rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                peak_rss = int(line.split()[1]) * 1024
+    return cpu, peak_rss
+
+
+class FakeCollector:
+    """本机上的假收集端：按 (分段, 偏移) 记下收到的块，按比例随机返回503让上传器重试"""
+
+    def __init__(self, fail_rate=0):
+        self.fail_rate = fail_rate
+        self.chunks = {}  # 分段名 -> {偏移: 数据}
+        self.final = set()  # 收到 X-Logcat-Final 的分段
+        self.requests = 0
+        self.rejected = 0
+        self.received_bytes = 0  # 收到的(压缩后)正文字节
+        self._lock = threading.Lock()
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 长连接
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with collector._lock:
+                    collector.requests += 1
+                    collector.received_bytes += len(body)
+                    rejected = random.random() < collector.fail_rate
+                    if rejected:
+                        collector.rejected += 1
+                    else:
+                        name = self.headers["X-Logcat-Segment"]
+                        data = gzip.decompress(body)
+                        assert len(data) == int(self.headers["X-Logcat-Length"])
+                        collector.chunks.setdefault(name, {})[int(self.headers["X-Logcat-Offset"])] = data
+                        if self.headers["X-Logcat-Final"] == "1":
+                            collector.final.add(name)
+                self.send_response(503 if rejected else 200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        # 在 fork 之前绑定端口，监控子进程只需要知道地址
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d/logcat" % self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def verify(self, log_dir, catalog):
+        """按偏移拼接收到的块，和磁盘上分段的原始内容核对，返回 (内容一致的分段数, 不一致的分段, 上传完整的分段数)"""
+        matched, mismatched, complete = 0, [], 0
+        for entry in catalog.snapshot():
+            chunks = self.chunks.get(entry["name"])
+            if not chunks:
+                continue
+            data = bytearray()
+            for offset in sorted(chunks):
+                if offset > len(data):
+                    break  # 中间有缺口
+                data[offset:offset + len(chunks[offset])] = chunks[offset]
+            path = catalog.locate(entry)
+            original = b"".join(logcat.read_segment_chunks(path)) if path else b""
+            if original[:len(data)] != bytes(data):
+                mismatched.append(entry["name"])
+                continue
+            matched += 1
+            if entry["name"] in self.final and len(data) == len(original):
+                complete += 1
+        return matched, mismatched, complete
+
+
+def run_monitor(workdir, packages, storm_limit=True, preallocate=False, buffers=logcat.LOGCAT_BUFFERS,
+                ship_url=None):
+    """子进程：把 logcat.py 的路径都指到工作目录，前台运行监控"""
+    log_dir = os.path.join(workdir, "logs")
+    logcat.LOG_DIR = log_dir
+    logcat.PID_FILE = os.path.join(log_dir, ".pid")
+    logcat.STATUS_FILE = os.path.join(log_dir, ".status.json")
+    logcat.CONFIG_FILE = os.path.join(log_dir, "monitor_config.json")
+    logcat.CATALOG_FILE = os.path.join(log_dir, ".segment_catalog.jsonl")
+    logcat.RULES_FILE = os.path.join(log_dir, "filter_rules.json")
+    logcat.PROFILE_DIR = os.path.join(log_dir, "profiles")
+    logcat.PROFILE_REQUEST_FILE = os.path.join(log_dir, ".profile_request.json")
+    logcat.WRITE_PREALLOCATE = preallocate
+    logcat.LOGCAT_BUFFERS = tuple(buffers)
+
+    with open(os.path.join(workdir, "monitor.log"), "w") as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+        os.dup2(f.fileno(), sys.stderr.fileno())
+
+    monitor = logcat.LogcatMonitor(packages)
+    monitor.pid_tracker.proc_dir = os.path.join(workdir, "proc")
+    monitor.tail.address = "\0logcat_bench_%d.tail" % os.getpid()
+    monitor.metrics_server.port = 0
+    if ship_url:
+        monitor.shipper.url = ship_url
+        monitor.shipper.interval = 1
+    if not storm_limit:
+        for channel in monitor.channels.values():
+            channel.suppressor.rate = 0
+    monitor.start_monitoring(daemon=False)
+
+
+def count_captured(log_dir, package):
+    """读回某个包的全部分段(含压缩的)，返回 (seq集合, 总行数)"""
+    seen = set()
+    total = 0
+    for name in os.listdir(log_dir):
+        if not name.startswith(package + "_") or name.endswith((".idx", ".tmp", ".stats")):
+            continue
+        path = os.path.join(log_dir, name)
+        # 二进制分段先解码回文本
+        chunks = logcat.query_segment(path, []) if logcat.is_binary_segment(path) else logcat.read_segment_chunks(path)
+        rest = b""
+        for chunk in chunks:
+            chunk = rest + chunk
+            cut = chunk.rfind(b"\n") + 1
+            rest = chunk[cut:]
+            for token in SEQ_PATTERN.findall(chunk, 0, cut):
+                seen.add(token)
+                total += 1
+    return seen, total
+
+
+def check_open_segments(log_dir):
+    """监控还在运行时对正在写的分段(预分配时末尾是预留的0)做 query 和 stats，返回 (分段数, 行数, 耗时, 问题)"""
+    catalog = logcat.SegmentCatalog(os.path.join(log_dir, os.path.basename(logcat.CATALOG_FILE)))
+    catalog.load()
+    started = time.perf_counter()
+    checked = lines = 0
+    problems = []
+    for entry in catalog.snapshot():
+        if entry["closed"]:
+            continue
+        path = os.path.join(log_dir, entry["file"])
+        queried = 0
+        for block in logcat.query_segment(path, logcat.read_segment_index(logcat.segment_index_path(path))):
+            if b"\0" in block:
+                problems.append(f"{entry['name']}: query 读到了预分配的0")
+                break
+            queried += block.count(b"\n")
+        summary = logcat.summarize_segment(path)
+        if summary["lines"] != queried:
+            problems.append(f"{entry['name']}: query {queried} 行, stats {summary['lines']} 行")
+        checked += 1
+        lines += queried
+    return checked, lines, time.perf_counter() - started, problems
+
+
+def count_generated(workdir, pid_owner):
+    """从假 logcat 的流水账里统计每个包实际输出的应用行"""
+    generated = {}
+    for name in os.listdir(workdir):
+        if not name.startswith("ledger."):
+            continue
+        writer_pid = name.split(".", 1)[1].encode()
+        with open(os.path.join(workdir, name), "rb") as f:
+            for line in f:
+                pid, seq = line.split()
+                package = pid_owner.get(pid.decode())
+                generated.setdefault(package, set()).add(writer_pid + b"-" + seq)
+    return generated
+
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="logcat_bench_")
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    package_names = [f"com.bench.app{i}" for i in range(args.packages)]
+    packages = [{"name": name, "max_file_size": int(args.file_size_mb * 1024 * 1024),
+                 "max_files": logcat.MAX_FILES, "max_total_size": logcat.MAX_TOTAL_SIZE,
+                 "segment_format": args.segment_format}
+                for name in package_names]
+
+    device = FakeDevice(workdir, package_names, args.app_restart)
+    collector = FakeCollector(args.ship_fail_rate) if args.ship else None
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({"proc_dir": device.proc_dir, "rate": args.rate, "app_share": args.app_share,
+                   "line_length": args.line_length, "logcat_restart": args.logcat_restart}, f)
+    os.environ["LOGCAT_BENCH_DIR"] = workdir
+    os.environ["PATH"] = device.bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+    print(f"工作目录: {workdir}")
+    print(f"包: {len(package_names)}, 速率: {args.rate or '不限'} 行/秒, 时长: {args.duration}s, "
+          f"应用重启: {args.app_restart or '无'}, logcat重启: {args.logcat_restart or '无'}")
+    sys.stdout.flush()
+
+    child = os.fork()
+    if child == 0:
+        try:
+            run_monitor(workdir, packages, storm_limit=not args.no_storm_limit, preallocate=args.preallocate,
+                        buffers=[buffer for buffer in args.buffers.split(",") if buffer],
+                        ship_url=collector.url if collector else None)
+        finally:
+            os._exit(0)
+
+    if collector:
+        collector.start()
+    started = time.monotonic()
+    profiling = bool(args.profile)
+    try:
+        while time.monotonic() - started < args.duration:
+            device.tick()
+            time.sleep(0.05)
+            if profiling and time.monotonic() - started >= 1:
+                # 和 profile 命令一样：写请求文件再发 SIGUSR2，剖析到产生日志结束
+                with open(os.path.join(workdir, "logs", ".profile_request.json"), "w") as f:
+                    json.dump({"mode": args.profile, "duration": args.duration - 1, "memory": args.profile_memory}, f)
+                os.kill(child, signal.SIGUSR2)
+                profiling = False
+        # 停止产生日志，等监控把管道里剩下的写完
+        open(os.path.join(workdir, "stop"), "w").close()
+        time.sleep(BENCH_DRAIN_SECONDS)
+        elapsed = time.monotonic() - started - BENCH_DRAIN_SECONDS
+        cpu, peak_rss = read_process_usage(child)
+        # 正在写的分段还没截断，查询只能读到数据末尾
+        open_check = check_open_segments(os.path.join(workdir, "logs")) if args.preallocate else None
+    finally:
+        os.kill(child, signal.SIGTERM)
+        os.waitpid(child, 0)
+        if collector:
+            collector.stop()
+
+    log_dir = os.path.join(workdir, "logs")
+    with open(os.path.join(log_dir, ".status.json")) as f:
+        status = json.load(f)
+    metrics = status.get("metrics", {})
+    counters = metrics.get("counters", {})
+    latency = metrics.get("latency", {})
+    lines_read = counters.get("logcat_read_lines_total", 0)
+
+    def latency_total(prefix):
+        entries = [value for key, value in latency.items() if key.startswith(prefix)]
+        return (sum(entry["avg_ms"] * entry["count"] for entry in entries) / 1000,
+                max((entry["p99_ms"] for entry in entries), default=0) / 1000)
+
+    rotate_total, rotate_p99 = latency_total("logcat_rotate_seconds")
+    merge_total, merge_p99 = latency_total("logcat_merge_seconds")
+    generated = count_generated(workdir, device.pid_owner)
+    catalog = logcat.SegmentCatalog(os.path.join(log_dir, os.path.basename(logcat.CATALOG_FILE)))
+    catalog.load()
+    per_package = {}
+    for name in package_names:
+        captured, captured_lines = count_captured(log_dir, name)
+        expected = generated.get(name, set())
+        # 风暴抑制和写入过载策略按设计丢弃(并记账)的行不算丢失
+        rate_limited = counters.get(f'logcat_storm_suppressed_lines_total{{kind="rate_limited",package="{name}"}}', 0)
+        overload = counters.get(f'logcat_overload_dropped_lines_total{{package="{name}"}}', 0)
+        per_package[name] = {
+            "generated": len(expected),
+            "captured": len(captured),
+            "rate_limited": rate_limited,
+            "overload_dropped": overload,
+            "lost": max(0, len(expected - captured) - rate_limited - overload),
+            "duplicated": captured_lines - len(captured),
+            "bytes_per_line": round(sum(entry["size"] or 0 for entry in catalog.package_segments(name))
+                                    / captured_lines, 1) if captured_lines else None,
+        }
+
+    result = {
+        "duration": round(elapsed, 2),
+        "lines_read": lines_read,
+        "lines_per_second": round(lines_read / elapsed),
+        "mb_per_second": round(counters.get("logcat_read_bytes_total", 0) / elapsed / 1024 / 1024, 2),
+        "cpu_seconds": round(cpu, 2),
+        "cpu_seconds_per_million_lines": round(cpu / lines_read * 1e6, 2) if lines_read else None,
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+        "rotation_stall_seconds": round(rotate_total, 4),
+        "rotation_p99_seconds": rotate_p99,
+        "write_blocked_seconds": round(sum(value for key, value in counters.items()
+                                           if key.startswith("logcat_write_blocked_seconds_total")), 3),
+        "merge_p99_seconds": merge_p99,
+        "merge_lines": counters.get("logcat_merge_lines_total", 0),
+        "merge_late_lines": counters.get("logcat_merge_late_lines_total", 0),
+        "handovers": counters.get("logcat_handovers_total", 0),
+        "lines_lost_reported": counters.get("logcat_lines_lost_total", 0),
+        "lines_lost": sum(entry["lost"] for entry in per_package.values()),
+        "lines_duplicated": sum(entry["duplicated"] for entry in per_package.values()),
+        "packages": per_package,
+    }
+    if open_check:
+        checked, checked_lines, seconds, problems = open_check
+        result["open_segments"] = {"segments": checked, "lines": checked_lines,
+                                   "seconds": round(seconds, 3), "problems": problems}
+    if args.profile:
+        result["profile_files"] = status.get("profile", {}).get("last_files", [])
+    if collector:
+        matched, mismatched, complete = collector.verify(log_dir, catalog)
+        result["ship"] = {
+            "requests": collector.requests,
+            "rejected": collector.rejected,
+            "shipped_mb": round(counters.get("logcat_ship_bytes_total", 0) / 1024 / 1024, 2),
+            "sent_mb": round(collector.received_bytes / 1024 / 1024, 2),
+            "p99_seconds": latency_total("logcat_ship_seconds")[1],
+            "backlog_mb": round(metrics.get("gauges", {}).get("logcat_ship_backlog_bytes", 0) / 1024 / 1024, 2),
+            "segments": len(catalog.segments),
+            "segments_matched": matched,
+            "segments_complete": complete,
+            "segments_mismatched": mismatched,
+        }
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"\n持续吞吐: {result['lines_per_second']} 行/秒 ({result['mb_per_second']}MB/s), "
+              f"共 {lines_read} 行, {result['duration']}s")
+        print(f"CPU: {result['cpu_seconds']}s, 每百万行 {result['cpu_seconds_per_million_lines']}s")
+        print(f"峰值RSS: {result['peak_rss_mb']}MB")
+        print(f"轮转耗时: 共 {result['rotation_stall_seconds']}s (p99 ≤ {rotate_p99}s), "
+              f"写入队列阻塞: {result['write_blocked_seconds']}s")
+        if result["merge_lines"] or merge_p99:
+            print(f"缓冲区归并: 重排窗口停留 p99 ≤ {merge_p99}s, 逐行归并 {result['merge_lines']} 行, "
+                  f"晚于窗口 {result['merge_late_lines']} 行")
+        print(f"logcat交接: {result['handovers']} 次, 监控自报丢失 {result['lines_lost_reported']} 行")
+        if open_check:
+            entry = result["open_segments"]
+            print(f"正在写的分段: {entry['segments']} 个, query/stats 读到 {entry['lines']} 行, "
+                  f"耗时 {entry['seconds']}s, 问题 {len(entry['problems'])} 个")
+        ship = result.get("ship")
+        if ship:
+            print(f"上传: {ship['requests']} 个请求 (503 {ship['rejected']} 个), 原始 {ship['shipped_mb']}MB -> "
+                  f"发送 {ship['sent_mb']}MB, p99 ≤ {ship['p99_seconds']}s, 结束时积压 {ship['backlog_mb']}MB; "
+                  f"分段 {ship['segments']} 个, 已完整上传 {ship['segments_complete']} 个, "
+                  f"内容不一致 {len(ship['segments_mismatched'])} 个")
+        if args.profile:
+            print(f"剖析结果({os.path.join(log_dir, 'profiles')}): {', '.join(result['profile_files']) or '无'}")
+        for name, entry in per_package.items():
+            print(f"  {name}: 产生 {entry['generated']} 行, 写入 {entry['captured']} 行, "
+                  f"限速丢弃 {entry['rate_limited']} 行, 过载丢弃 {entry['overload_dropped']} 行, "
+                  f"丢失 {entry['lost']} 行, 重复 {entry['duplicated']} 行, 分段 {entry['bytes_per_line']} 字节/行")
+
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failed = []
+    if args.min_rate and result["lines_per_second"] < args.min_rate:
+        failed.append(f"吞吐 {result['lines_per_second']} < {args.min_rate} 行/秒")
+    if args.max_lost is not None and result["lines_lost"] > args.max_lost:
+        failed.append(f"丢失 {result['lines_lost']} > {args.max_lost} 行")
+    if open_check:
+        failed.extend(result["open_segments"]["problems"])
+    if collector and result["ship"]["segments_mismatched"]:
+        failed.append(f"上传内容和分段不一致: {', '.join(result['ship']['segments_mismatched'])}")
+    for message in failed:
+        print(f"未达标: {message}", file=sys.stderr)
+    return not failed
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1].startswith("fake-"):
+        command = {"fake-logcat": fake_logcat, "fake-pidof": fake_pidof, "fake-ps": fake_ps}[sys.argv[1]]
+        try:
+            command(sys.argv[2:])
+        except (BrokenPipeError, KeyboardInterrupt):
+            pass
+        return
+
+    parser = argparse.ArgumentParser(description="Logcat监控器管道基准(假 logcat，不需要设备)")
+    parser.add_argument("--packages", type=int, default=BENCH_PACKAGES, help="监控的包数")
+    parser.add_argument("--rate", type=int, default=BENCH_RATE, help="每秒输出的总行数，0 表示不限速")
+    parser.add_argument("--duration", type=float, default=BENCH_DURATION, help="运行秒数")
+    parser.add_argument("--app-share", type=float, default=BENCH_APP_SHARE, help="被监控应用的行所占比例")
+    parser.add_argument("--line-length", default=BENCH_LINE_LENGTH, help="消息长度分布，长度:权重,...")
+    parser.add_argument("--app-restart", type=float, default=BENCH_APP_RESTART,
+                        help="应用每隔几秒换一次PID，0 表示不重启")
+    parser.add_argument("--logcat-restart", type=float, default=BENCH_LOGCAT_RESTART,
+                        help="logcat 每隔几秒退出一次，0 表示不退出")
+    parser.add_argument("--no-storm-limit", action="store_true", help="关闭按TAG限速，测不限速时的完整写入")
+    parser.add_argument("--segment-format", choices=["text", "binary"], default=logcat.SEGMENT_FORMAT,
+                        help="分段格式")
+    parser.add_argument("--preallocate", action="store_true", help="预分配分段文件(WRITE_PREALLOCATE)")
+    parser.add_argument("--buffers", default=",".join(logcat.LOGCAT_BUFFERS),
+                        help="分别读取的缓冲区(逗号分隔，空字符串表示只读默认缓冲区的一个流)")
+    parser.add_argument("--ship", action="store_true", help="上传到本机假收集端并核对收到的内容")
+    parser.add_argument("--ship-fail-rate", type=float, default=0, help="假收集端随机返回503的请求比例")
+    parser.add_argument("--profile", choices=logcat.PROFILE_MODES, help="运行期间剖析监控进程(SIGUSR2)")
+    parser.add_argument("--profile-memory", action="store_true", help="剖析时同时跟踪内存分配(tracemalloc)")
+    parser.add_argument("--file-size-mb", type=float, default=BENCH_FILE_SIZE_MB, help="分段大小(MB)")
+    parser.add_argument("--workdir", help="工作目录(默认临时目录，结束后删除)")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    parser.add_argument("--min-rate", type=int, help="吞吐低于该值(行/秒)时退出码为1")
+    parser.add_argument("--max-lost", type=int, help="丢失行数超过该值时退出码为1")
+    args = parser.parse_args()
+
+    if not sys.platform.startswith("linux"):
+        print("错误: 需要 Linux (/proc)")
+        sys.exit(1)
+    if not run_benchmark(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()